@@ -1,12 +1,17 @@
-from mediafile import MediaFile
-from mediafile import MediaField
-from mediafile import MP3DescStorageStyle
-from mediafile import MP4StorageStyle
-from mediafile import StorageStyle
-from mediafile import ASFStorageStyle
-from mediafile import UnreadableFileError
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import lru_cache
+from collections import Counter
+from collections import deque
 from pathlib import Path
+from types import SimpleNamespace
+import threading
 import uuid
+import re
+import json
+import sys
+import io
 import os
 
 __version__ = '0.1.0'
@@ -33,95 +38,380 @@ file_types = [
     '.wv',
 ]
 
+_FILE_TYPES = frozenset(file_types)
 
-mediafield = MediaField(
-    MP3DescStorageStyle(u'AUDIOLINK_ID'),
-    MP4StorageStyle('----:com.apple.iTunes:Audiolink Id'),
-    StorageStyle('AUDIOLINK_ID'),
-    ASFStorageStyle('Audiolink/Id'),
-)
+# tag reads and writes mostly wait on disk, so use more threads than cores
+_max_workers = min(32, (os.cpu_count() or 1) * 4)
 
+# files submitted ahead of the one being collected in AudiolinkFolder scans
+_max_in_flight = 256
 
-class _MediaFile(MediaFile):
-    """ Class for adding Audiolink Id field. Avoids conflicts with other instances of MediaFile
+# files smaller than this can't hold audio, they are reported without being parsed
+_min_file_size = 128
+
+
+# mediafile and mutagen are imported on first file access by _load_mediafile,
+# so AudiolinkId can be used without loading them. What it sets up is kept here.
+_lib = SimpleNamespace(MediaFile=None)
+_load_lock = threading.Lock()
+
+# module attributes served from _lib, loading it on first access
+_lib_names = {
+    '_MediaFile': 'MediaFile',
+    'mediafield': 'mediafield',
+    'UnreadableFileError': 'UnreadableFileError',
+    'MutagenError': 'MutagenError',
+    'ID3': 'ID3',
+}
+
+
+def __getattr__(name:str):
+    if name not in _lib_names:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    _load_mediafile()
+    return getattr(_lib, _lib_names[name])
+
+
+def _load_mediafile() -> None:
+    """ Imports mediafile and mutagen and sets up the Audiolink Id field on first call.
+    """
+    if _lib.MediaFile is not None:
+        return
+
+    with _load_lock:
+        if _lib.MediaFile is not None:
+            return
+
+        from mediafile import MediaFile
+        from mediafile import MediaField
+        from mediafile import MP3DescStorageStyle
+        from mediafile import MP4StorageStyle
+        from mediafile import StorageStyle
+        from mediafile import ASFStorageStyle
+        from mediafile import UnreadableFileError
+        from mediafile import mutagen_call
+        from mutagen import MutagenError
+        from mutagen.aiff import AIFF
+        from mutagen.asf import ASF
+        from mutagen.dsf import DSF
+        from mutagen.flac import FLAC
+        from mutagen.id3 import ID3
+        from mutagen.monkeysaudio import MonkeysAudio
+        from mutagen.mp3 import MP3
+        from mutagen.mp4 import MP4
+        from mutagen.musepack import Musepack
+        from mutagen.oggopus import OggOpus
+        from mutagen.oggvorbis import OggVorbis
+        from mutagen.wave import WAVE
+        from mutagen.wavpack import WavPack
+
+        field = MediaField(
+            MP3DescStorageStyle(u'AUDIOLINK_ID'),
+            MP4StorageStyle('----:com.apple.iTunes:Audiolink Id'),
+            StorageStyle('AUDIOLINK_ID'),
+            ASFStorageStyle('Audiolink/Id'),
+        )
+
+        class AudiolinkMediaFile(MediaFile):
+            """ Class for adding Audiolink Id field. Avoids conflicts with other instances of MediaFile
+            """
+            def __init__(self, filething, id3v23=False) -> None:
+                super().__init__(filething, id3v23)
+
+        AudiolinkMediaFile.add_field('audiolink_id', field)
+
+        # mutagen classes used to read the id without format detection, by file suffix
+        _lib.id_readers = {
+            '.aiff': AIFF,
+            '.ape': MonkeysAudio,
+            '.dsf': DSF,
+            '.flac': FLAC,
+            '.m4a': MP4,
+            '.mpc': Musepack,
+            '.ogg': OggVorbis,
+            '.opus': OggOpus,
+            '.wav': WAVE,
+            '.wma': ASF,
+            '.wv': WavPack,
+        }
+
+        class TagResize(UnreadableFileError):
+            """ Stops a save that would move the audio data, see AudiolinkFile._write.
+                An UnreadableFileError so mutagen_call passes it through unchanged.
+            """
+
+        # mutagen classes with tags ahead of the audio data that check the padding before writing
+        _lib.padded_types = (ASF, FLAC, MP3, MP4, OggOpus, OggVorbis)
+
+        _lib.mutagen_call = mutagen_call
+        _lib.TagResize = TagResize
+        _lib.mediafield = field
+        _lib.UnreadableFileError = UnreadableFileError
+        _lib.MutagenError = MutagenError
+        _lib.ID3 = ID3
+        # Set last, it marks the loading as done
+        _lib.MediaFile = AudiolinkMediaFile
+
+
+# files up to this size are saved through an in memory buffer when their tag needs to grow
+_buffer_max_size = 8 * 1024 * 1024
+
+
+def _write_changes(fp:str, old:bytes, new:bytes) -> None:
+    """ Writes new over the file at fp, which holds old, skipping the blocks they share.
+        The file is written in place rather than replaced so hard links to it stay intact.
+    """
+    old = memoryview(old)
+    new = memoryview(new)
+    block = 64 * 1024
+    n = min(len(old), len(new))
+    start = 0
+
+    while start < n and old[start:start + block] == new[start:start + block]:
+        start += block
+
+    end = len(new)
+
+    # With the size unchanged the shared tail can be skipped too
+    if len(old) == len(new):
+        while end - block > start and old[end - block:end] == new[end - block:end]:
+            end -= block
+
+    if start >= end and len(old) == len(new):
+        return
+
+    with open(fp, 'r+b') as f:
+        f.seek(start)
+        f.write(new[start:end])
+
+        if len(old) != len(new):
+            f.truncate()
+
+
+_style_cache = {}
+
+
+def _styles_for(mgfile) -> list:
+    """ Returns the mediafield storage styles for a mutagen file, resolved once per file type.
+    """
+    styles = _style_cache.get(type(mgfile))
+
+    if styles is None:
+        styles = list(_lib.mediafield.styles(mgfile))
+        _style_cache[type(mgfile)] = styles
+
+    return styles
+
+
+def _read_id(fp:str) -> str:
+    """ Reads only the Audiolink Id tag of a file.
+        Skips the format detection of a full MediaFile, and for mp3 the audio stream parse.
+        Falls back to _MediaFile when the direct read fails.
+    """
+    _load_mediafile()
+    suffix = os.path.splitext(fp)[1].lower()
+
+    try:
+        if suffix == '.mp3':
+            for frame in _lib.ID3(fp).getall('TXXX'):
+                if frame.desc.lower() == 'audiolink_id':
+                    return frame.text[0]
+
+            return None
+
+        mgfile = _lib.id_readers[suffix](fp)
+
+    except (KeyError, _lib.MutagenError):
+        return _lib.MediaFile(fp).audiolink_id
+
+    if mgfile.tags is None:
+        return None
+
+    out = None
+    for style in _styles_for(mgfile):
+        out = style.get(mgfile)
+        if out:
+            break
+
+    if isinstance(out, bytes):
+        out = out.decode('utf-8', 'ignore')
+
+    return out
+
+
+@lru_cache(maxsize=4096)
+def _read_id_cached(fp:str, st_ino:int, st_mtime_ns:int, st_ctime_ns:int) -> str:
+    """ Cached _read_id. Keyed on inode, mtime and ctime as well, so a replaced or retagged file is read again.
     """
-    def __init__(self, filething, id3v23=False) -> None:
-        super().__init__(filething, id3v23)
+    return _read_id(fp)
+
+
+def _uuid_hex(val:str) -> str:
+    """ Returns the 32 digit lowercase hex form of a UUID string, raises ValueError if not a UUID.
+        Plain hex is checked by bytes.fromhex without building a UUID, other forms go through uuid.UUID.
+    """
+    if len(val) == 32:
+        try:
+            if len(bytes.fromhex(val)) == 16:
+                return val.lower()
+        except ValueError:
+            pass
 
-_MediaFile.add_field('audiolink_id', mediafield)
+    return uuid.UUID(val).hex
+
+
+# random bytes for new ids are read from the OS in chunks rather than 16 at a time
+_entropy_size = 16 * 256
+_entropy = b''
+_entropy_pos = 0
+_entropy_lock = threading.Lock()
+
+
+def _reset_entropy() -> None:
+    global _entropy, _entropy_pos
+    _entropy = b''
+    _entropy_pos = 0
+
+
+# A forked child must not hand out the same ids as its parent
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_entropy)
+
+
+def _new_hex() -> str:
+    """ Returns the 32 digit hex form of a new random (version 4) UUID, without building a UUID.
+    """
+    global _entropy, _entropy_pos
+
+    with _entropy_lock:
+        if _entropy_pos + 16 > len(_entropy):
+            _entropy = os.urandom(_entropy_size)
+            _entropy_pos = 0
+
+        b = bytearray(_entropy[_entropy_pos:_entropy_pos + 16])
+        _entropy_pos += 16
+
+    b[6] = b[6] & 0x0f | 0x40
+    b[8] = b[8] & 0x3f | 0x80
+    return b.hex()
 
 
 class AudiolinkId:
     """ Class for Audiolink Id.
     """
-    _suffix = '-al'
+    suffix = '-al'
+    _suffix_len = len(suffix)
 
     def __init__(self, val:str = None) -> None:
-        self._uuid = None
+        self._hex = None
         self.val = val
 
     @property
     def val(self) -> str:
-        if self._uuid is None:
+        if self._hex is None:
             return None
         
-        return f'{self._uuid.hex}{AudiolinkId.suffix}' 
+        return f'{self._hex}{AudiolinkId.suffix}' 
 
     @val.setter
     def val(self, id:str) -> None:
         if id is None:
-            self._uuid = None
+            self._hex = None
             return
 
         id = str(id)
-        n = len(AudiolinkId.suffix)
 
-        if id[-n:] != AudiolinkId.suffix:
+        if not id.endswith(AudiolinkId.suffix):
             raise ValueError(f'must end with "{AudiolinkId.suffix}"')
 
-        self._uuid = uuid.UUID(id[:-n])
+        self._hex = _uuid_hex(id[:-AudiolinkId._suffix_len])
 
     '''
     def set_new(self) -> None:
         self._uuid = uuid.uuid4().hex
     '''
 
-    @classmethod
-    @property
-    def suffix(cls):
-        return cls._suffix
-
     @classmethod
     def new(cls):
         """ Creates instance with newly generated id
         """
-        return AudiolinkId(uuid.uuid4().hex + cls.suffix)
+        obj = cls.__new__(cls)
+        obj._hex = _new_hex()
+        return obj
+
+# marks an id that has not been read yet, None is a valid id value
+_unread = object()
+
 
 class AudiolinkFile:
     """ Class for Audiolink operations on media files.
         fp can be changed by using cls.fp = fp
     """
+    # One instance per file in folder operations, so no per-instance __dict__
+    __slots__ = ('_path', '_tag', '_id', '_batch', '_dirty')
+
     def __init__(self, fp:str = None) -> None:
+        _load_mediafile()
         self._path = None
         self._tag = None
+        self._id = _unread
+        self._batch = False
+        self._dirty = False
         self.path = fp
 
+    def __enter__(self):
+        """ Defers tag saves until the block exits, so several changes are written at once.
+        """
+        self._batch = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._batch = False
+
+        if exc_type is None:
+            self.flush()
+
+        self._dirty = False
+
     @property
     def path(self) -> Path:
-        return self._path
+        if self._path is None:
+            return None
+
+        return Path(self._path)
 
     @path.setter
     def path(self, fp:str) -> None:
+        self.flush()
+        self._tag = None
+        self._id = _unread
+
         if fp is None:
             self._path = None
-            self._tag = None
             return
 
-        self._path = Path(fp)
-        self._tag = _MediaFile(self.path)
+        # Held as str, Path is only built when path is read
+        self._path = os.fspath(fp)
+
+    @property
+    def _media(self):
+        """ The file's tags, parsed on first use.
+        """
+        if self._tag is None:
+            self._tag = _lib.MediaFile(self._path)
+
+        return self._tag
 
     @property
     def id(self) -> str:
+        if self._tag is None:
+            # Reading the id alone doesn't need the full parse
+            if self._id is _unread:
+                self._id = _read_id(self._path)
+
+            return self._id
+
         return self._tag.audiolink_id
 
     @id.setter
@@ -139,18 +429,70 @@ class AudiolinkFile:
         if id is None:
             raise ValueError('AudiolinkId has no value')
 
-        self._tag.audiolink_id = str(id)
-        self._tag.save()
+        self._media.audiolink_id = str(id)
+        self._save()
 
     @id.deleter
     def id(self) -> None:
         """ Removes Audiolink Id tag from file.
         """
-        #TODO: explore only using specific file style rather than all
-        for style in mediafield.styles(self._tag.mgfile):
-            style.delete(self._tag.mgfile)
+        tag = self._media
+
+        for style in _styles_for(tag.mgfile):
+            style.delete(tag.mgfile)
+
+        self._save()
+
+    def flush(self) -> None:
+        """ Writes tag changes deferred by a with block to the file.
+        """
+        if not self._dirty:
+            return
+
+        self._dirty = False
+        self._write()
+
+    def _save(self) -> None:
+        if self._batch:
+            self._dirty = True
+            return
+
+        self._write()
+
+    def _write(self) -> None:
+        mgfile = self._tag.mgfile
+
+        # Tags at the end of the file are resized without moving the audio data
+        if not isinstance(mgfile, _lib.padded_types):
+            self._tag.save()
+            return
 
-        self._tag.save()
+        buffered = os.path.getsize(self._path) <= _buffer_max_size
+
+        def padding(info) -> int:
+            # A tag that fits its padding is rewritten in place, only the header is written
+            if info.padding >= 0:
+                return info.padding
+
+            if buffered:
+                raise _lib.TagResize(self._path, 'tag does not fit its padding')
+
+            return info.get_default_padding()
+
+        try:
+            self._tag.save(padding=padding)
+            return
+        except _lib.TagResize:
+            pass
+
+        # Small files that need a resize are tagged in memory, then only the changed bytes are written back
+        with open(self._path, 'rb') as f:
+            data = f.read()
+
+        buf = io.BytesIO(data)
+        kwargs = {'v2_version': 3} if self._tag.id3v23 else {}
+        _lib.mutagen_call('save', self._path, mgfile.save, buf, **kwargs)
+        _write_changes(self._path, data, buf.getvalue())
 
 
 class AudiolinkFileLink:
@@ -159,6 +501,7 @@ class AudiolinkFileLink:
     def __init__(self, file:AudiolinkFile = None, dest:str = None) -> None:
         self._file = None
         self._dest = None
+        self._file_ino_cache = None
         
         self.file = file
         self.dest = dest
@@ -169,6 +512,8 @@ class AudiolinkFileLink:
 
     @file.setter
     def file(self, file) -> None:
+        self._file_ino_cache = None
+
         if file is None:
             self._file = None
             return
@@ -180,7 +525,10 @@ class AudiolinkFileLink:
 
     @property
     def dest(self) -> Path:
-        return self._dest
+        if self._dest is None:
+            return None
+
+        return Path(self._dest)
 
     @dest.setter
     def dest(self, dest:str) -> None:
@@ -188,64 +536,99 @@ class AudiolinkFileLink:
             self._dest = None
             return
 
-        link_dir = Path(dest)
+        link_dir = os.fspath(dest)
 
-        if not link_dir.is_dir():
+        if not os.path.isdir(link_dir):
             raise ValueError('dest is not a dir')
 
         self._dest = link_dir
         
     @property
     def link_name(self) -> str:
-        return f'{self.file.id}{self.file.path.suffix}'
+        return f'{self.file.id}{os.path.splitext(self.file._path)[1]}'
 
     @property
     def link_path(self) -> Path:
-        return self.dest.joinpath(self.link_name)
+        return Path(self._link_fp)
+
+    @property
+    def _link_fp(self) -> str:
+        return os.path.join(self._dest, self.link_name)
 
     @property
     def link_status(self) -> str:
         """ Checks the dir for a link file and returns the status.
         """
-        if not self.link_path.exists():
+        return self._link_status(self._link_fp)
+
+    def _link_status(self, link_fp:str) -> str:
+        try:
+            link_stat = os.stat(link_fp)
+        except FileNotFoundError:
             return None
 
-        if self.link_path.stat().st_ino == self.file.path.stat().st_ino:
+        if link_stat.st_ino == self._file_ino():
             return 'active'
-        
-        elif AudiolinkFile(self.link_path).id == self.file.id:
-            return 'inactive'
+
+        try:
+            if _read_id_cached(link_fp, link_stat.st_ino, link_stat.st_mtime_ns, link_stat.st_ctime_ns) == self.file.id:
+                return 'inactive'
+        except _lib.UnreadableFileError:
+            pass
 
         return 'conflict'
 
+    def _file_ino(self) -> int:
+        """ Returns the inode of the file, cached until the file or its path changes.
+        """
+        path = self.file._path
+
+        if self._file_ino_cache is None or self._file_ino_cache[0] != path:
+            self._file_ino_cache = (path, os.stat(path).st_ino)
+
+        return self._file_ino_cache[1]
+
     def create_link(self, overwrite:bool = False) -> None:
         """ Creates a hard link in dest path with Audiolink Id as file name.
         """
-        if self.link_status is None:
+        link_fp = self._link_fp
+
+        # Link first, the status check is only needed when something is already there
+        try:
+            os.link(self.file._path, link_fp)
+            return
+        except FileExistsError:
             pass
 
-        elif self.link_status == 'active':
+        link_status = self._link_status(link_fp)
+
+        if link_status == 'active':
             return
         
-        elif self.link_status == 'inactive':
+        elif link_status == 'inactive':
             if not overwrite:
                 raise FileExistsError('file exists in dest with link name and id')
 
-        else:
+            os.unlink(link_fp)
+
+        elif link_status is not None:
             raise FileExistsError('file exists in dest with link name')
 
-        os.link(self.file.path, self.link_path)
+        os.link(self.file._path, link_fp)
 
     def delete_link(self, force:bool = True) -> None:
         """ Removes hard link in dest path if exists with file Audiolink Id.
         """
-        if self.link_status is None:
+        link_fp = self._link_fp
+        link_status = self._link_status(link_fp)
+
+        if link_status is None:
             return #TODO: Warning no link detected
 
-        elif self.link_status == 'active':
-            self.link_path.unlink()
+        elif link_status == 'active':
+            os.unlink(link_fp)
 
-        elif self.link_status == 'inactive':
+        elif link_status == 'inactive':
             if not force:
                 raise FileExistsError('file exists in dest with link name and id')
         
@@ -253,12 +636,236 @@ class AudiolinkFileLink:
             raise FileExistsError('file exists in dest with link name')
 
 
+def _iter_audio(root:str):
+    """ Yields paths of supported audio files under root.
+        Uses os.scandir so entries are filtered by name without a stat per file.
+    """
+    stack = [root]
+
+    while stack:
+        path = stack.pop()
+
+        try:
+            it = os.scandir(path)
+        except OSError:
+            # Skip folders that can't be listed, as rglob and os.walk do
+            if path is root:
+                raise
+            continue
+
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+
+                elif entry.is_file(follow_symlinks=False):
+                    name = entry.name
+                    dot = name.rfind('.')
+
+                    # dot > 0 so a bare dotfile such as '.mp3' has no suffix, as with Path.suffix
+                    if dot > 0 and name[dot:].lower() in _FILE_TYPES:
+                        yield entry.path
+
+
+def _done(result) -> Future:
+    """ Wraps a value in an already completed future.
+    """
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+# canonical form of an id as written by AudiolinkId
+_id_re = re.compile(r'\A[0-9a-f]{32}' + re.escape(AudiolinkId.suffix) + r'\Z')
+
+
+def _id_is_valid(id:str) -> bool:
+    if id is None:
+        return False
+
+    # Ids written by AudiolinkId match in one regex call, other forms get the full parse
+    if _id_re.match(id) is not None:
+        return True
+
+    # Most invalid ids are rejected here, without raising in the parse below
+    if not id.endswith(AudiolinkId.suffix) or len(id) < 32 + AudiolinkId._suffix_len:
+        return False
+
+    try:
+        return AudiolinkId(id).val is not None
+    except ValueError:
+        return False
+
+
+def _id_matches_status(id:str, id_valid:bool, status:str) -> bool:
+    """ Checks if an id falls under the status used to select files in set_ids.
+    """
+    if status == 'missing':
+        return id is None
+
+    if status == 'invalid':
+        return id is not None and not id_valid
+
+    return False
+
+
+# stat fields that must match for AudiolinkFolder.scan_folder to reuse an indexed id
+_index_keys = ('mtime_ns', 'ctime_ns', 'ino', 'size')
+
+
+def _analyze_file(elem:dict, link_path:Path = None, index:dict = None, links:dict = None) -> dict:
+    """ Reads the Audiolink Id and link status of a file for AudiolinkFolder.scan_folder.
+        The id is taken from index instead when the file's mtime, ctime, inode and size have not changed since.
+        links maps the names in link_path to their inodes, see _scan_links, and is
+        compared against the inode from the stat in _map_files.
+        Kept at module level so it can be dispatched to a worker pool.
+    """
+    fp = elem.get('path')
+    prev = index.get(fp) if index else None
+
+    # mtime alone is kept by copies such as cp -p and by taggers that restore it,
+    # so the file must also keep its inode, its size and its ctime, which user space can't set
+    if prev is not None and all(prev.get(k) == elem.get(k) for k in _index_keys):
+        id = prev.get('id')
+
+    else:
+        id = _read_id(fp)
+
+    id_valid = _id_is_valid(id)
+
+    output = {
+            'path': fp, #TODO resolve path?
+            'id': id,
+            'id_valid': id_valid,
+            'mtime_ns': elem.get('mtime_ns'),
+            'ctime_ns': elem.get('ctime_ns'),
+            'ino': elem.get('ino'),
+            'size': elem.get('size'),
+        }
+
+    if link_path:
+        output['link_status'] = None
+
+        if id_valid:
+            link_ino = links.get(f'{id}{os.path.splitext(fp)[1]}')
+
+            # Only a name that is taken needs a stat, and only a different inode needs the full check
+            if link_ino is None:
+                pass
+
+            elif link_ino == elem.get('ino'):
+                output['link_status'] = 'active'
+
+            else:
+                output['link_status'] = AudiolinkFileLink(AudiolinkFile(fp), link_path).link_status
+
+    return output
+
+
+def _scan_links(link_path:Path) -> dict:
+    """ Returns the inode of each entry in link_path by name, empty if link_path does not exist.
+        DirEntry.inode() comes from the directory listing, without a stat per entry.
+    """
+    try:
+        with os.scandir(link_path) as it:
+            return {entry.name: entry.inode() for entry in it}
+
+    except FileNotFoundError:
+        return {}
+
+
+def _fix_file(elem:dict, link_path:Path = None, status:str = 'missing', create_links:bool = False) -> dict:
+    """ Reads the Audiolink Id of a file for AudiolinkFolder.scan_and_fix, sets a new id
+        if it matches status and optionally creates the link, in a single pass over the file.
+    """
+    fp = elem.get('path')
+    al_file = AudiolinkFile(fp)
+    # Only the id is read, the tags are fully parsed only for files that get a new one
+    id = al_file.id
+    id_valid = _id_is_valid(id)
+
+    if _id_matches_status(id, id_valid, status):
+        al_file.id = AudiolinkId.new()
+        id = al_file.id
+        id_valid = True
+
+    output = {
+            'path': fp, #TODO resolve path?
+            'id': id,
+            'id_valid': id_valid,
+            'mtime_ns': elem.get('mtime_ns'),
+            'ctime_ns': elem.get('ctime_ns'),
+            'ino': elem.get('ino'),
+            'size': elem.get('size'),
+        }
+
+    if link_path:
+        al_link = AudiolinkFileLink(al_file, link_path)
+
+        if create_links and id_valid:
+            al_link.create_link()
+
+        output['link_status'] = al_link.link_status if id_valid else None
+
+    return output
+
+
+def _records_not_in(records, paths:set):
+    """ Yields the records whose path is not in paths.
+    """
+    return (elem for elem in records if elem.get('path') not in paths)
+
+
+_file_states = ('missing', 'invalid', 'valid', 'linked')
+
+
+def _record_states(elem:dict) -> list:
+    """ Returns the AudiolinkFolder.file_list states of a scan record.
+    """
+    if elem.get('id') is None:
+        states = ['missing']
+
+    elif elem.get('id_valid'):
+        states = ['valid']
+
+    else:
+        states = ['invalid']
+
+    if elem.get('link_status') == 'active':
+        states.append('linked')
+
+    return states
+
+
+def _bucket_records(records) -> dict:
+    """ Sorts scan record paths by file_list state in a single pass.
+    """
+    buckets = {state: [] for state in _file_states}
+    buckets['any'] = []
+
+    for elem in records:
+        fp = elem.get('path')
+        buckets['any'].append(fp)
+
+        for state in _record_states(elem):
+            buckets[state].append(fp)
+
+    return buckets
+
+
 class AudiolinkFolder:
     """ Class for bulk Audiolink operations for files in a folder.
     """
+    index_name = '.audiolink_cache'
+
+    __slots__ = ('_path', '_link_path', '_cache', '_cache_file', '_buckets')
+
     def __init__(self, path:str = None, link_path:str = None) -> None:
         self._path = None
         self._link_path = None
+        self._cache = []
+        self._cache_file = None
+        self._buckets = None
 
         self.path = path
         self.link_path = link_path
@@ -300,48 +907,257 @@ class AudiolinkFolder:
 
         self._link_path = new_path
 
-    def scan_folder(self) -> None:
+    def scan_folder(self, save_to:str = None, use_index:bool = True) -> None:
+        """ Scans the folder for audio files and their Audiolink Ids.
+            With save_to, results are streamed to that file as JSON lines instead of kept in memory.
+            With use_index, ids are kept in an index file in the folder and only files
+            modified since the last scan are read again. The index is held in memory,
+            so it is not used with save_to, or saved when the folder is read only.
+        """
         #TODO: look into warning for softlinks if found
+        print('Scanning...')
+        use_index = use_index and save_to is None
+        index = self._load_index() if use_index else None
+        self._cache_file = Path(save_to) if save_to is not None else None
+        links = _scan_links(self.link_path) if self.link_path else None
+        self._map_files(_analyze_file, self._walk(), self.link_path, index, links, links=links)
 
-        al_file = AudiolinkFile()
-        al_id = AudiolinkId()
-        al_link = AudiolinkFileLink()
+        if use_index:
+            self._save_index()
 
-        def analyze(fp):
+        self._print_results()
+
+    @property
+    def _index_file(self) -> Path:
+        return self.path.joinpath(AudiolinkFolder.index_name)
+
+    def _load_index(self) -> dict:
+        """ Returns the records of the last indexed scan by path.
+        """
+        try:
+            with open(self._index_file) as f:
+                return {elem.get('path'): elem for elem in map(json.loads, f)}
+
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self) -> None:
+        tmp_file = self._index_file.with_name(AudiolinkFolder.index_name + '.tmp')
+
+        # The index only saves work on the next scan, a folder that can't be written is scanned without it
+        try:
+            with open(tmp_file, 'w') as f:
+                for elem in self._records():
+                    json.dump({'path': elem.get('path'), 'id': elem.get('id'), **{k: elem.get(k) for k in _index_keys}}, f)
+                    f.write('\n')
+
+            os.replace(tmp_file, self._index_file)
+
+        except OSError:
             try:
-                al_file.path = fp
-                al_id.val = al_file.id
-            except UnreadableFileError as e:
-                print(e)
-                return None
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+
+    def scan_and_fix(self, status:str='missing', create_links:bool=False, save_to:str = None) -> None:
+        """ Scans the folder, sets new ids on files matching status and optionally creates links.
+            Each file is read once, instead of once each for scan_folder, set_ids and update_links.
+            Only the id is read, the tags are fully parsed only for files that get a new id,
+            which is saved in place when it fits the tag's padding.
+        """
+        if create_links and self.link_path is None:
+            raise ValueError('link path not set')
+
+        print('Scanning...')
+        self._cache_file = Path(save_to) if save_to is not None else None
+        self._map_files(_fix_file, self._walk(), self.link_path, status, create_links)
+        self._print_results()
+
+    def _walk(self):
+        return ({'path': fp} for fp in _iter_audio(self.path))
+
+    def _map_files(self, fn, elems, *args, select = None, links:dict = None) -> None:
+        """ Runs fn(elem, *args) over file records and stores the results in the cache.
+            Records rejected by select are kept as they are.
+            Paths that are hard links to the same file are only processed once.
+            links is the listing of link_path from _scan_links, read here if not given.
+            Files that can't be read are left out, and reported together once all are done.
+        """
+        _load_mediafile()
+        errors = []
+        in_flight = deque()
+
+        if links is None and self.link_path is not None:
+            links = _scan_links(self.link_path)
+
+        # Names in link_path don't show up in the walk, so they are not waited for in seen
+        link_counts = Counter(links.values()) if links else {}
+
+        def jobs():
+            # Shared result and the number of paths to it still expected, dropped once all are seen
+            seen = {}
+
+            for elem in elems:
+                fp = elem.get('path')
+
+                if select is not None and not select(elem):
+                    in_flight.append((fp, _done(elem)))
+                    continue
+
+                try:
+                    st = os.stat(fp)
+                except FileNotFoundError:
+                    errors.append(f'{fp}: file not found')
+                    continue
+
+                if st.st_size < _min_file_size:
+                    errors.append(f'{fp}: file too small to be audio')
+                    continue
+
+                key = (st.st_dev, st.st_ino)
+                elem = dict(elem, mtime_ns=st.st_mtime_ns, ctime_ns=st.st_ctime_ns, ino=st.st_ino, size=st.st_size)
+
+                if key in seen:
+                    future, remaining = seen[key]
+                    in_flight.append((fp, future))
+
+                    if remaining > 1:
+                        seen[key] = (future, remaining - 1)
+                    else:
+                        del seen[key]
 
+                else:
+                    future = ex.submit(fn, elem, *args)
+                    in_flight.append((fp, future))
+                    remaining = st.st_nlink - 1 - link_counts.get(st.st_ino, 0)
+
+                    if remaining > 0:
+                        seen[key] = (future, remaining)
+
+                # Bound the files in flight so results can be streamed out as they finish
+                if len(in_flight) > _max_in_flight:
+                    yield in_flight.popleft()
+
+            while in_flight:
+                yield in_flight.popleft()
+
+        def collect(fp:str, future:Future) -> dict:
             try:
-                id_valid = True if al_id.val is not None else False
-            except ValueError:
-                id_valid = False
-
-            output = {
-                    'path': str(fp), #TODO resolve path?
-                    'id': al_id.val,
-                    'id_valid': id_valid,
-                }
-
-            if self.link_path:
-                al_link.file = al_file
-                al_link.link_path = self.link_path
-                output['link_status'] = al_link.link_status
-                
+                output = future.result()
+            except (_lib.UnreadableFileError, FileNotFoundError) as e:
+                errors.append(str(e))
+                return None
+
+            if output is not None and output.get('path') != fp:
+                output = dict(output, path=fp)
+
             return output
 
-        files = (fp for fp in self.path.rglob('*') if fp.is_file() and fp.suffix in set(file_types))
+        def results():
+            try:
+                for fp, future in jobs():
+                    output = collect(fp, future)
 
-        print('Scanning...')
-        self._cache = [analyze(fp) for fp in files]
-        
-        count_files = len(self._cache)
-        count_id_missing = len([1 for _ in self._cache if _.get('id') is None])
-        count_id_valid = len([1 for _ in self._cache if _.get('id_valid')])
-        count_id_not_valid = len([1 for _ in self._cache if _.get('id') is not None and not _.get('id_valid')])
+                    if output is not None:
+                        yield output
+
+            except Exception:
+                # Files already changed by other workers are still stored before the error is raised
+                for fp, future in in_flight:
+                    try:
+                        output = collect(fp, future)
+                    except Exception:
+                        continue
+
+                    if output is not None:
+                        yield output
+
+                raise
+
+        try:
+            # Tag reads are independent per file, spread them over a thread pool
+            with ThreadPoolExecutor(max_workers=_max_workers) as ex:
+                self._store(results())
+
+        finally:
+            # One write for all errors, rather than a print per file from the workers,
+            # also when the pass is cut short so the errors found so far are not lost
+            if errors:
+                sys.stdout.write('\n'.join(errors) + '\n')
+
+    def _records(self):
+        """ Yields the cached scan results, from the save_to file if one was used.
+        """
+        if self._cache_file is None:
+            yield from self._cache
+            return
+
+        with open(self._cache_file) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def _store(self, records) -> None:
+        """ Replaces the cached scan results, writing them to the save_to file if one was used.
+            If records fails partway, what was stored is kept along with the previous
+            results for the files not reached, so changes already made to files are not lost.
+        """
+        self._buckets = None
+
+        if self._cache_file is None:
+            prev = self._cache
+            cache = []
+
+            try:
+                cache.extend(records)
+
+            except BaseException:
+                cache.extend(_records_not_in(prev or (), {elem.get('path') for elem in cache}))
+                raise
+
+            finally:
+                self._cache = cache
+                self._buckets = _bucket_records(cache)
+
+            return
+
+        self._cache = None
+        tmp_file = self._cache_file.with_name(self._cache_file.name + '.tmp')
+
+        try:
+            with open(tmp_file, 'w') as f:
+                for elem in records:
+                    json.dump(elem, f)
+                    f.write('\n')
+
+        except BaseException:
+            with open(tmp_file) as f:
+                paths = {json.loads(line).get('path') for line in f}
+
+            with open(tmp_file, 'a') as f:
+                for elem in _records_not_in(self._records() if self._cache_file.exists() else (), paths):
+                    json.dump(elem, f)
+                    f.write('\n')
+
+            os.replace(tmp_file, self._cache_file)
+            raise
+
+        os.replace(tmp_file, self._cache_file)
+
+    def _print_results(self) -> None:
+        count_files = 0
+        count_id_missing = 0
+        count_id_valid = 0
+
+        for elem in self._records():
+            count_files += 1
+
+            if elem.get('id') is None:
+                count_id_missing += 1
+
+            elif elem.get('id_valid'):
+                count_id_valid += 1
+
+        count_id_not_valid = count_files - count_id_missing - count_id_valid
         
         print(f'Scan Results: \n'
             + f'  Files........ {count_files} \n'
@@ -350,28 +1166,32 @@ class AudiolinkFolder:
             + f'  Id Missing... {count_id_missing}'
         )
 
+    def file_list(self, status:str = None) -> list:
+        """ Returns the paths of scanned files with status 'missing', 'invalid', 'valid' or 'linked',
+            or of all scanned files when status is None.
+        """
+        if status is not None and status not in _file_states:
+            raise ValueError(f'status must be one of {_file_states}')
+
+        # Results saved to a file are bucketed on the first query, so later ones don't read the file again
+        if self._buckets is None:
+            self._buckets = _bucket_records(self._records())
+
+        return list(self._buckets[status or 'any'])
+
     def scan_links(self):
         pass
 
     def set_ids(self, status:str='missing') -> None:
-        al_file = AudiolinkFile()
-
-        def operate_on_file(val:dict):
-            if status == 'missing':
-                if val.get('id') is None:
-                    return True
-            
-            if status == 'invalid':
-                if val.get('id') is not None and not val.get('id_valid'):
-                    return True
-            
-            return False
-
-        for i, elem in enumerate(self._cache):
-            if operate_on_file(elem):
-                al_file.path = elem.get('path')
+        def set_id(elem:dict) -> dict:
+            with AudiolinkFile(elem.get('path')) as al_file:
                 al_file.id = AudiolinkId.new()
-                self._cache[i]['id'] = al_file.id
+
+            return dict(elem, id=al_file.id, id_valid=True)
+
+        # Tag writes are independent per file, overlap them in a thread pool
+        self._map_files(set_id, self._records(),
+            select=lambda elem: _id_matches_status(elem.get('id'), elem.get('id_valid'), status))
 
 
     def delete_ids(self) -> None:
@@ -379,12 +1199,11 @@ class AudiolinkFolder:
         if response != 'Y':
             return
 
-        al_file = AudiolinkFile()
+        def delete_id(elem:dict) -> dict:
+            del AudiolinkFile(elem.get('path')).id
+            return dict(elem, id=None, id_valid=False)
 
-        for i, elem in enumerate(self._cache):
-            al_file.path = elem.get('path')
-            del al_file.id
-            self._cache[i]['id'] = None
+        self._map_files(delete_id, self._records())
 
 
     def update_links(self):
@@ -395,13 +1214,96 @@ class AudiolinkFolder:
         self.scan_links()
         #TODO: delete all that are not active (move to alternate folder)
 
-        al_file = AudiolinkFile()
-        al_link = AudiolinkFileLink()
-        
-        #TODO: Skip Active
-        for i, elem in enumerate(self._cache):
-            al_file.path = elem.get('path')
-            al_link.file = al_file
-            al_link.link_path = self.link_path
-            al_link.create_link()
-            self._cache[i]['link_status'] = al_link.link_status
+        dir_fd = None
+
+        # Link names are resolved against an open handle on link_path rather than its full path each time
+        if {os.link, os.stat} <= os.supports_dir_fd:
+            dir_fd = os.open(self.link_path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+
+        def link(elem:dict, link_fp:str) -> dict:
+            fp = elem.get('path')
+
+            try:
+                os.link(fp, link_fp, dst_dir_fd=dir_fd)
+            except FileExistsError:
+                # Another record with the same id, such as a hard link in the folder, got there first
+                AudiolinkFileLink(AudiolinkFile(fp), self.link_path).create_link()
+
+            return dict(elem, link_status='active')
+
+        def link_after(elem:dict, prev:Future) -> dict:
+            # Runs once the earlier record with the same link name is done, create_link sorts out what it left
+            wait([prev])
+            AudiolinkFileLink(AudiolinkFile(elem.get('path')), self.link_path).create_link()
+            return dict(elem, link_status='active')
+
+        # Futures of link names submitted in this pass and not yet collected, so one name is linked at a time
+        pending = {}
+
+        def update_link(elem:dict, link_name:str) -> Future:
+            # Sort out new and active links by inode, only existing files at the link name need a full check
+            fp = elem.get('path')
+            link_fp = link_name if dir_fd is not None else os.path.join(self.link_path, link_name)
+
+            if link_name in pending:
+                return ex.submit(link_after, elem, pending[link_name])
+
+            try:
+                link_ino = os.stat(link_fp, dir_fd=dir_fd).st_ino
+            except FileNotFoundError:
+                # Linking is a metadata only syscall per file, overlap them in a thread pool
+                return ex.submit(link, elem, link_fp)
+
+            if link_ino != os.stat(fp).st_ino:
+                AudiolinkFileLink(AudiolinkFile(fp), self.link_path).create_link()
+
+            return _done(dict(elem, link_status='active'))
+
+        in_flight = deque()
+
+        def jobs():
+            for elem in self._records():
+                if not elem.get('id_valid'):
+                    in_flight.append((None, _done(elem)))
+                    continue
+
+                link_name = f'{elem.get("id")}{os.path.splitext(elem.get("path"))[1]}'
+                future = update_link(elem, link_name)
+                pending[link_name] = future
+                in_flight.append((link_name, future))
+
+                if len(in_flight) > _max_in_flight:
+                    yield in_flight.popleft()
+
+            while in_flight:
+                yield in_flight.popleft()
+
+        def results():
+            # A record is stored once its link exists, so link_status is never ahead of the folder
+            try:
+                for link_name, future in jobs():
+                    # Once collected the link is on disk, later records with the name find it there
+                    if pending.get(link_name) is future:
+                        del pending[link_name]
+
+                    yield future.result()
+
+            except Exception:
+                # Links already made by other workers are still stored before the error is raised
+                for _, future in in_flight:
+                    try:
+                        output = future.result()
+                    except Exception:
+                        continue
+
+                    yield output
+
+                raise
+
+        try:
+            with ThreadPoolExecutor(max_workers=_max_workers) as ex:
+                self._store(results())
+
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
@@ -0,0 +1,137 @@
+import pytest
+import audiolink.audiolink as al
+from pathlib import Path
+import shutil
+import os
+
+
+# Config
+file_types = [
+    '.aiff',
+    '.alac.m4a',
+    '.ape',
+    '.dsf',
+    '.flac',
+    '.m4a',
+    '.mp3',
+    '.mpc',
+    '.ogg',
+    '.opus',
+    '.wav',
+    '.wma',
+    '.wv',
+]
+
+
+# Global Settings
+resource_path = Path('tests/resources')
+al_id_suffix = '-al'
+
+known_id = {
+    'valid': '0' * 32 + al_id_suffix,
+    'invalid_hex': 'z' * 32 + al_id_suffix,
+    'invalid_suffix': '0' * 32 + '-zz',
+}
+
+valid_id = known_id['valid']
+invalid_hex_id = known_id['invalid_hex']
+invalid_suffix_id = known_id['invalid_suffix']
+
+
+# Fixtures
+@pytest.fixture(scope='session')
+def media_cache(tmp_path_factory) -> Path:
+    # Resources are copied once per session, tests copy from here or read the files in place
+    root = tmp_path_factory.mktemp('media')
+
+    for file_state in ('empty', 'full'):
+        for ft in file_types:
+            fn = f'{file_state}{ft}'
+            shutil.copy(resource_path.joinpath(fn), root.joinpath(fn))
+
+    return root
+
+
+@pytest.fixture
+def media_file(media_cache:Path, tmp_path:Path):
+    def _file(file_state:str, file_type:str) -> Path:
+        fn = f'{file_state}{file_type}'
+        dest = tmp_path.joinpath(fn)
+        shutil.copy(media_cache.joinpath(fn), dest)
+        return dest
+
+    return _file
+
+
+@pytest.fixture
+def media_file_ro(media_cache:Path, tmp_path:Path):
+    # Hard linked to the session copy, only for tests that don't write to the file
+    def _file(file_state:str, file_type:str) -> Path:
+        fn = f'{file_state}{file_type}'
+        dest = tmp_path.joinpath(fn)
+
+        try:
+            os.link(media_cache.joinpath(fn), dest)
+        except OSError:
+            shutil.copy(media_cache.joinpath(fn), dest)
+
+        return dest
+
+    return _file
+
+
+@pytest.fixture
+def media_file_cached(media_cache:Path):
+    # Shared between tests, only for tests that don't write to the file
+    def _file(file_state:str, file_type:str) -> Path:
+        return media_cache.joinpath(f'{file_state}{file_type}')
+
+    return _file
+
+
+@pytest.fixture
+def media_file_empty(media_file):
+    def _file(file_type:str) -> Path:
+        return media_file('empty', file_type)
+
+    return _file
+
+
+@pytest.fixture
+def media_file_full(media_file):
+    def _file(file_type:str) -> Path:
+        return media_file('full', file_type)
+
+    return _file
+
+
+@pytest.fixture(scope='session')
+def audiolink_file_cache(media_cache:Path):
+    # Read once per session, only for tests that don't change the file or the instance
+    return {ft: al.AudiolinkFile(media_cache.joinpath(f'full{ft}')) for ft in file_types}
+
+
+@pytest.fixture(scope='session')
+def audiolinkid_valid():
+    return al.AudiolinkId(valid_id)
+
+
+@pytest.fixture
+def audiolink_folder_empty(media_file_empty):
+    for ft in file_types:
+        media_file_empty(ft)
+
+@pytest.fixture
+def audiolink_folder(media_file_full, media_file_empty):
+    for ft in file_types:
+        media_file_full(ft)
+        media_file_empty(ft)
+
+    return
+
+
+@pytest.fixture
+def audiolink_folder_ro(media_file_ro):
+    for ft in file_types:
+        media_file_ro('full', ft)
+        media_file_ro('empty', ft)
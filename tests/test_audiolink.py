@@ -1,93 +1,60 @@
 import pytest
 import audiolink.audiolink as al
 from pathlib import Path
+import subprocess
 import shutil
 import uuid
+import sys
+import os
+
+from .conftest import file_types
+from .conftest import al_id_suffix
+from .conftest import valid_id
+from .conftest import invalid_hex_id
+from .conftest import invalid_suffix_id
 
 
 # Config
 version = '0.1.0'
 
-file_types = [
-    '.aiff',
-    '.alac.m4a',
-    '.ape',
-    '.dsf',
-    '.flac',
-    '.m4a',
-    '.mp3',
-    '.mpc',
-    '.ogg',
-    '.opus',
-    '.wav',
-    '.wma',
-    '.wv',
-]
-
-
-# Global Settings
-resource_path = Path('tests/resources')
-al_id_suffix = '-al'
-
-known_id = {
-    'valid': '0' * 32 + al_id_suffix,
-    'invalid_hex': 'z' * 32 + al_id_suffix,
-    'invalid_suffix': '0' * 32 + '-zz',
-}
-
-
-# Fixtures
-@pytest.fixture
-def media_file(tmp_path:Path):
-    def _file(file_state:str, file_type:str) -> Path:
-        fn = f'{file_state}{file_type}'
-        src = resource_path.joinpath(fn)
-        dest = tmp_path.joinpath(fn)
-        shutil.copy(src, dest)
-        return dest
-
-    return _file
-
-
-@pytest.fixture
-def media_file_empty(media_file):
-    def _file(file_type:str) -> Path:
-        return media_file('empty', file_type)
-
-    return _file
-
 
-@pytest.fixture
-def media_file_full(media_file):
-    def _file(file_type:str) -> Path:
-        return media_file('full', file_type)
-
-    return _file
-
-
-@pytest.fixture
-def audiolinkid_valid():
-    return al.AudiolinkId(known_id.get('valid'))
+# Tests
+# General
+def test_version():
+    assert al.__version__ == version
 
 
-@pytest.fixture
-def audiolink_folder_empty(media_file_empty):
-    for ft in file_types:
-        media_file_empty(ft)
+def test_lazy_import():
+    # a fresh interpreter, so the names are imported before any file access
+    code = (
+        'from audiolink.audiolink import UnreadableFileError, AudiolinkId\n'
+        'assert issubclass(UnreadableFileError, Exception)\n'
+        'AudiolinkId.new()\n'
+    )
+    subprocess.run([sys.executable, '-c', code], check=True)
 
-@pytest.fixture
-def audiolink_folder(media_file_full, media_file_empty):
-    for ft in file_types:
-        media_file_full(ft)
-        media_file_empty(ft)
 
-    return
+@pytest.mark.parametrize('file_type', file_types)
+def test_read_id(media_file_cached, file_type):
+    assert al._read_id(str(media_file_cached('full', file_type))) == valid_id
+    assert al._read_id(str(media_file_cached('empty', file_type))) is None
 
 
-# Tests
-# General
-def test_version():
-    assert al.__version__ == version
+@pytest.mark.parametrize(
+    'val, expected',
+    [
+        (valid_id, True),
+        (valid_id.upper()[:32] + al_id_suffix, True),
+        (str(uuid.UUID(int=0)) + al_id_suffix, True),
+        (invalid_hex_id, False),
+        (invalid_suffix_id, False),
+        ('0' * 31 + al_id_suffix, False),
+        (None, False),
+    ],
+    ids=['valid', 'upper', 'dashed', 'invalid_hex', 'invalid_suffix', 'short', 'none']
+)
+def test_id_is_valid_check(val:str, expected:bool):
+    assert al._id_is_valid(val) is expected
 
 
 # AudiolinkId
@@ -107,14 +74,28 @@ class TestAudiolinkId:
             except ValueError:
                 assert False
 
+        def test_AudiolinkId_new_uuid4(self):
+            n = len(al_id_suffix)
+            # Enough ids to cross a refill of the entropy chunk
+            ids = [al.AudiolinkId.new().val[:-n] for _ in range(al._entropy_size // 16 + 1)]
+            assert len(set(ids)) == len(ids)
+            assert all(uuid.UUID(_).version == 4 for _ in ids)
+            assert all(uuid.UUID(_).variant == uuid.RFC_4122 for _ in ids)
+
+        def test_AudiolinkId_val_normalized(self):
+            u = uuid.uuid4()
+            assert al.AudiolinkId(u.hex.upper() + al_id_suffix).val == u.hex + al_id_suffix
+            assert al.AudiolinkId(str(u) + al_id_suffix).val == u.hex + al_id_suffix
+
     @pytest.mark.parametrize(
         'val, expected',
         [
             (None, True),
-            (known_id.get('valid'), True),
-            (known_id.get('invalid_hex'), False),
-            (known_id.get('invalid_suffix'), False),
-        ]
+            (valid_id, True),
+            (invalid_hex_id, False),
+            (invalid_suffix_id, False),
+        ],
+        ids=['none', 'valid', 'invalid_hex', 'invalid_suffix']
     )
     class TestInstance:
         def test_AudiolinkId_init(self, val:str, expected:bool):
@@ -144,27 +125,79 @@ class TestAudiolinkId:
 # AudiolinkFile
 @pytest.mark.parametrize('file_type', file_types)
 class TestAudiolinkFile:
-    def test_AudiolinkFile_init(self, media_file_empty, file_type):
-        fp = media_file_empty(file_type)
+    def test_AudiolinkFile_init(self, media_file_cached, file_type):
+        fp = media_file_cached('empty', file_type)
         file = al.AudiolinkFile(fp)
         assert file.path == fp
 
-    def test_AudiolinkFile_id_getter(self, media_file_full, file_type):
-        fp = media_file_full(file_type)
+    def test_AudiolinkFile_id_getter(self, media_file_cached, file_type):
+        fp = media_file_cached('full', file_type)
         file = al.AudiolinkFile(fp)
-        assert file.id == known_id.get('valid')
+        assert file.id == valid_id
 
     def test_AudiolinkFile_id_setter(self, media_file_empty, file_type, audiolinkid_valid):
         fp = media_file_empty(file_type)
         file = al.AudiolinkFile(fp)
         assert file.id is None
         file.id = audiolinkid_valid
-        assert file.id == known_id.get('valid')
+        assert file.id == valid_id
+
+    def test_AudiolinkFile_batch(self, media_file_empty, file_type, audiolinkid_valid):
+        fp = media_file_empty(file_type)
+
+        with al.AudiolinkFile(fp) as file:
+            file.id = audiolinkid_valid
+            assert al.AudiolinkFile(fp).id is None
+
+        assert al.AudiolinkFile(fp).id == valid_id
+
+    def test_AudiolinkFile_flush(self, media_file_empty, file_type, audiolinkid_valid):
+        fp = media_file_empty(file_type)
+
+        with al.AudiolinkFile(fp) as file:
+            file.id = audiolinkid_valid
+            file.flush()
+            assert al.AudiolinkFile(fp).id == valid_id
+
+    def test_AudiolinkFile_write_in_place(self, media_file_full, file_type, monkeypatch):
+        fp = media_file_full(file_type)
+        file = al.AudiolinkFile(fp)
+        file._media
+        modes = []
+        _open = open
+
+        def open_logged(file, mode='r', *args, **kwargs):
+            if os.fspath(file) == str(fp):
+                modes.append(mode)
+
+            return _open(file, mode, *args, **kwargs)
+
+        monkeypatch.setattr('builtins.open', open_logged)
+        del file.id
+        monkeypatch.undo()
+        assert file.id is None
+        # the file is not read again for the save
+        assert 'rb' not in modes
+
+    def test_AudiolinkFile_write_error(self, media_file_empty, file_type, audiolinkid_valid, monkeypatch):
+        import mutagen
+        file = al.AudiolinkFile(media_file_empty(file_type))
+
+        def fail(*args, **kwargs):
+            raise mutagen.MutagenError('save failed')
+
+        monkeypatch.setattr(file._media.mgfile, 'save', fail)
+
+        try:
+            file.id = audiolinkid_valid
+            assert False
+        except al.UnreadableFileError:
+            assert True
 
     def test_AudiolinkFile_id_deleter(self, media_file_full, file_type):
         fp = media_file_full(file_type)
         file = al.AudiolinkFile(fp)
-        assert file.id == known_id.get('valid')
+        assert file.id == valid_id
         del file.id
         assert file.id is None
 
@@ -174,17 +207,28 @@ class TestAudiolinkFile:
 class TestAudiolinkFileLink:
     #TODO: file and path setter and getter, link_status, edge cases
 
-    def test_AudiolinkFileLink_link_name(self, media_file_full, file_type, tmp_path:Path):
-        fp = media_file_full(file_type)
-        file = al.AudiolinkFile(fp)
+    def test_AudiolinkFileLink_link_name(self, audiolink_file_cache, file_type, tmp_path:Path):
+        file = audiolink_file_cache[file_type]
         link = al.AudiolinkFileLink(file, tmp_path)
         assert link.link_name == f'{file.id}{file.path.suffix}'
 
-    def test_AudiolinkFileLink_link_path(self, media_file_full, file_type, tmp_path:Path):
+    def test_AudiolinkFileLink_link_path(self, audiolink_file_cache, file_type, tmp_path:Path):
+        file = audiolink_file_cache[file_type]
+        link = al.AudiolinkFileLink(file, tmp_path)
+        assert link.link_path == tmp_path.joinpath(f'{file.id}{file.path.suffix}')
+
+    def test_AudiolinkFileLink_link_status(self, media_file_full, file_type, tmp_path:Path):
         fp = media_file_full(file_type)
         file = al.AudiolinkFile(fp)
         link = al.AudiolinkFileLink(file, tmp_path)
-        assert link.link_path == tmp_path.joinpath(f'{file.id}{file.path.suffix}')
+        assert link.link_status is None
+        link.create_link()
+        assert link.link_status == 'active'
+        link.delete_link()
+        shutil.copy(fp, link.link_path)
+        assert link.link_status == 'inactive'
+        link.link_path.write_bytes(b'')
+        assert link.link_status == 'conflict'
 
     def test_AudiolinkFileLink_create_link(self,  media_file_full, file_type, tmp_path:Path):
         fp = media_file_full(file_type)
@@ -195,6 +239,32 @@ class TestAudiolinkFileLink:
         link.create_link()
         assert link_fp.exists()
 
+    def test_AudiolinkFileLink_create_link_overwrite(self, media_file_full, file_type, tmp_path:Path):
+        fp = media_file_full(file_type)
+        file = al.AudiolinkFile(fp)
+        link = al.AudiolinkFileLink(file, tmp_path)
+        shutil.copy(fp, link.link_path)
+        assert link.link_status == 'inactive'
+
+        try:
+            link.create_link()
+            assert False
+        except FileExistsError:
+            assert True
+
+        link.create_link(overwrite=True)
+        assert link.link_status == 'active'
+
+    def test_AudiolinkFileLink_tag_change(self, media_file_full, file_type, tmp_path:Path):
+        fp = media_file_full(file_type)
+        file = al.AudiolinkFile(fp)
+        link = al.AudiolinkFileLink(file, tmp_path)
+        link.create_link()
+        link_fp = link.link_path
+        del file.id
+        assert al.AudiolinkFile(link_fp).id is None
+        assert link_fp.stat().st_ino == fp.stat().st_ino
+
     def test_AudiolinkFileLink_delete_link(self,  media_file_full, file_type, tmp_path:Path):
         fp = media_file_full(file_type)
         file = al.AudiolinkFile(fp)
@@ -250,18 +320,300 @@ class TestAudiolinkFolder:
         except ValueError:
             assert True
 
-    def test_AudiolinkFolder_scan(self, audiolink_folder, tmp_path:Path):
-        #audiolink_folder()
-        pass
+    def test_AudiolinkFolder_scan(self, audiolink_folder_ro, tmp_path:Path):
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        assert len(al_folder._cache) == len(file_types) * 2
+        assert len([1 for _ in al_folder._cache if _.get('id') == valid_id]) == len(file_types)
+        assert len([1 for _ in al_folder._cache if _.get('id') is None]) == len(file_types)
+        assert all(_.get('ino') == os.stat(_.get('path')).st_ino for _ in al_folder._cache)
+
+    def test_AudiolinkFolder_scan_unreadable(self, audiolink_folder_empty, tmp_path:Path, capsys):
+        tmp_path.joinpath('unreadable.flac').write_text('not audio' * 100)
+        tmp_path.joinpath('truncated.mp3').write_text('not audio')
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        assert len(al_folder._cache) == len(file_types)
+        out = capsys.readouterr().out
+        assert 'unreadable.flac' in out
+        assert 'truncated.mp3' in out
+
+    def test_AudiolinkFolder_file_list(self, audiolink_folder, tmp_path:Path, tmp_path_factory):
+        link_path = tmp_path_factory.mktemp('links')
+        al_folder = al.AudiolinkFolder(tmp_path, link_path)
+        al_folder.scan_folder()
+        assert len(al_folder.file_list()) == len(file_types) * 2
+        assert len(al_folder.file_list('valid')) == len(file_types)
+        assert len(al_folder.file_list('missing')) == len(file_types)
+        assert al_folder.file_list('invalid') == []
+        assert al_folder.file_list('linked') == []
+
+        al_folder.set_ids()
+        assert len(al_folder.file_list('valid')) == len(file_types) * 2
+
+        save_to = tmp_path_factory.mktemp('index').joinpath('scan.jsonl')
+        al_folder.scan_folder(save_to=save_to)
+        assert len(al_folder.file_list('valid')) == len(file_types) * 2
+
+    def test_AudiolinkFolder_scan_save_to(self, audiolink_folder, tmp_path:Path, tmp_path_factory):
+        save_to = tmp_path_factory.mktemp('index').joinpath('scan.jsonl')
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder(save_to=save_to)
+        assert al_folder._cache is None
+        assert not tmp_path.joinpath(al.AudiolinkFolder.index_name).exists()
+        assert len(save_to.read_text().splitlines()) == len(file_types) * 2
+        assert len(al_folder.file_list('missing')) == len(file_types)
+        al_folder.set_ids()
+        assert all(_.get('id') is not None for _ in al_folder._records())
+        assert al_folder.file_list('missing') == []
+
+    def test_AudiolinkFolder_scan_index(self, audiolink_folder_ro, tmp_path:Path, monkeypatch):
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        assert tmp_path.joinpath(al.AudiolinkFolder.index_name).exists()
+        cache = al_folder._cache
+
+        # unchanged files are not read again
+        monkeypatch.setattr(al, '_read_id', None)
+        al_folder.scan_folder()
+        assert al_folder._cache == cache
+
+    def test_AudiolinkFolder_scan_index_replaced(self, media_file_full, media_file_empty, tmp_path:Path):
+        fp = media_file_full('.flac')
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        assert al_folder._cache[0].get('id') == valid_id
+
+        # a file copied over with its mtime kept, as cp -p does
+        mtime_ns = fp.stat().st_mtime_ns
+        tmp_fp = media_file_empty('.flac').rename(tmp_path.joinpath('empty.tmp'))
+        os.utime(tmp_fp, ns=(mtime_ns, mtime_ns))
+        tmp_fp.replace(fp)
+        al_folder.scan_folder()
+        assert al_folder._cache[0].get('id') is None
+
+    def test_AudiolinkFolder_scan_index_retagged(self, media_file_full, tmp_path:Path):
+        fp = media_file_full('.flac')
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        assert al_folder._cache[0].get('id') == valid_id
+
+        # retagged in place with its mtime restored, keeping inode and size
+        st = fp.stat()
+        new_id = al.AudiolinkId.new().val
+        media = al._MediaFile(fp)
+        media.audiolink_id = new_id
+        media.save()
+        os.utime(fp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert (fp.stat().st_ino, fp.stat().st_size) == (st.st_ino, st.st_size)
+        al_folder.scan_folder()
+        assert al_folder._cache[0].get('id') == new_id
+
+    def test_AudiolinkFolder_scan_index_read_only(self, audiolink_folder_ro, tmp_path:Path, monkeypatch, capsys):
+        def fail(*args, **kwargs):
+            raise PermissionError
+
+        monkeypatch.setattr(al.os, 'replace', fail)
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        assert 'Scan Results' in capsys.readouterr().out
+        assert not tmp_path.joinpath(al.AudiolinkFolder.index_name).exists()
+        assert not tmp_path.joinpath(al.AudiolinkFolder.index_name + '.tmp').exists()
+
+    def test_AudiolinkFolder_scan_walk(self, media_file_ro, tmp_path:Path):
+        subdir = tmp_path.joinpath('subdir')
+        subdir.mkdir()
+        media_file_ro('full', '.flac').rename(subdir.joinpath('full.flac'))
+        media_file_ro('full', '.mp3').rename(tmp_path.joinpath('FULL.MP3'))
+        tmp_path.joinpath('cover.jpg').touch()
+        tmp_path.joinpath('.mp3').touch()
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        assert sorted(Path(_.get('path')).name for _ in al_folder._cache) == ['FULL.MP3', 'full.flac']
+
+    def test_AudiolinkFolder_scan_hard_links(self, media_file_empty, tmp_path:Path):
+        fp = media_file_empty('.flac')
+        os.link(fp, tmp_path.joinpath('copy.flac'))
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_and_fix()
+        assert len(al_folder._cache) == 2
+        assert al_folder._cache[0].get('id') == al_folder._cache[1].get('id')
+        assert sorted(_.get('path') for _ in al_folder._cache) == sorted([str(fp), str(tmp_path.joinpath('copy.flac'))])
+
+    def test_AudiolinkFolder_scan_and_fix(self, audiolink_folder_empty, tmp_path:Path, tmp_path_factory):
+        link_path = tmp_path_factory.mktemp('links')
+        al_folder = al.AudiolinkFolder(tmp_path, link_path)
+        al_folder.scan_and_fix(create_links=True)
+        assert len(al_folder._cache) == len(file_types)
+        assert all(_.get('id_valid') for _ in al_folder._cache)
+        assert all(_.get('link_status') == 'active' for _ in al_folder._cache)
+        assert len(list(link_path.iterdir())) == len(file_types)
+
+    def test_AudiolinkFolder_scan_and_fix_parses(self, media_file_full, tmp_path:Path, monkeypatch):
+        fp = media_file_full('.mp3')
+        media_file_full('.flac')
+        del al.AudiolinkFile(fp).id
+        parsed = []
+
+        class CountedMediaFile(al._MediaFile):
+            def __init__(self, filething, id3v23=False) -> None:
+                parsed.append(os.fspath(filething))
+                super().__init__(filething, id3v23)
+
+        monkeypatch.setattr(al._lib, 'MediaFile', CountedMediaFile)
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_and_fix()
+        assert all(_.get('id_valid') for _ in al_folder._cache)
+        # only the file that got a new id is fully parsed
+        assert parsed == [str(fp)]
+        parsed.clear()
+        al_folder.scan_and_fix()
+        assert parsed == []
+
+    def test_AudiolinkFolder_set_ids(self, audiolink_folder, tmp_path:Path):
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        al_folder.set_ids()
+        assert all(_.get('id_valid') for _ in al_folder._cache)
+        assert len([1 for _ in al_folder._cache if _.get('id') == valid_id]) == len(file_types)
+
+        for elem in al_folder._cache:
+            assert al.AudiolinkFile(elem.get('path')).id == elem.get('id')
+
+    def test_AudiolinkFolder_set_ids_vanished(self, audiolink_folder_empty, tmp_path:Path, capsys):
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        tmp_path.joinpath('empty.flac').unlink()
+        al_folder.set_ids()
+        assert 'empty.flac' in capsys.readouterr().out
+        assert len(al_folder._cache) == len(file_types) - 1
+
+        for elem in al_folder._cache:
+            assert al.AudiolinkFile(elem.get('path')).id == elem.get('id')
+
+    @pytest.mark.parametrize('save_to', [False, True], ids=['cache', 'save_to'])
+    def test_AudiolinkFolder_set_ids_partial(self, audiolink_folder_empty, tmp_path:Path, tmp_path_factory, monkeypatch, save_to:bool):
+        write = al.AudiolinkFile._write
+
+        def fail_mp3(file):
+            if file._path.endswith('.mp3'):
+                raise PermissionError(file._path)
+
+            write(file)
+
+        monkeypatch.setattr(al.AudiolinkFile, '_write', fail_mp3)
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder(save_to=tmp_path_factory.mktemp('index').joinpath('scan.jsonl') if save_to else None)
+
+        try:
+            al_folder.set_ids()
+            assert False
+        except PermissionError:
+            assert True
+
+        records = list(al_folder._records())
+        assert len(records) == len(file_types)
+        assert len([1 for _ in records if _.get('id') is not None]) == len(file_types) - 1
 
-    def test_AudiolinkFolder_set_ids(self):
-        pass
+        for elem in records:
+            assert al.AudiolinkFile(elem.get('path')).id == elem.get('id')
 
-    def test_AudiolinkFolder_delete_ids(self):
-        pass
+    def test_AudiolinkFolder_set_ids_partial_errors(self, audiolink_folder_empty, tmp_path:Path, monkeypatch, capsys):
+        def fail(file):
+            raise PermissionError(file._path)
+
+        monkeypatch.setattr(al.AudiolinkFile, '_write', fail)
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        tmp_path.joinpath('empty.flac').unlink()
+
+        try:
+            al_folder.set_ids()
+            assert False
+        except PermissionError:
+            assert True
 
-    def test_AudiolinkFolder_create_links(self):
-        pass
+        # errors found before the pass stopped are still reported
+        assert 'empty.flac' in capsys.readouterr().out
+
+    def test_AudiolinkFolder_delete_ids(self, audiolink_folder, tmp_path:Path, monkeypatch):
+        monkeypatch.setattr('builtins.input', lambda _: 'Y')
+        al_folder = al.AudiolinkFolder(tmp_path)
+        al_folder.scan_folder()
+        al_folder.delete_ids()
+        assert all(_.get('id') is None for _ in al_folder._cache)
+
+        for elem in al_folder._cache:
+            assert al.AudiolinkFile(elem.get('path')).id is None
+
+    def test_AudiolinkFolder_create_links(self, audiolink_folder_empty, tmp_path:Path, tmp_path_factory):
+        link_path = tmp_path_factory.mktemp('links')
+        al_folder = al.AudiolinkFolder(tmp_path, link_path)
+        al_folder.scan_folder()
+        al_folder.set_ids()
+        al_folder.update_links()
+        assert all(_.get('link_status') == 'active' for _ in al_folder._cache)
+        assert len(list(link_path.iterdir())) == len(file_types)
+        # already active links are skipped
+        al_folder.update_links()
+        assert len(list(link_path.iterdir())) == len(file_types)
+        al_folder.scan_folder()
+        assert len(al_folder.file_list('linked')) == len(file_types)
+
+    def test_AudiolinkFolder_create_links_hard_links(self, media_file_empty, tmp_path:Path, tmp_path_factory):
+        link_path = tmp_path_factory.mktemp('links')
+
+        for i in range(50):
+            fp = media_file_empty('.flac').rename(tmp_path.joinpath(f'{i}.flac'))
+            os.link(fp, tmp_path.joinpath(f'{i}b.flac'))
+
+        al_folder = al.AudiolinkFolder(tmp_path, link_path)
+        al_folder.scan_folder()
+        al_folder.set_ids()
+        al_folder.update_links()
+        assert all(_.get('link_status') == 'active' for _ in al_folder._cache)
+        assert len(list(link_path.iterdir())) == 50
+        # each pair now has a third name in link_path
+        al_folder.scan_folder(use_index=False)
+        assert len(al_folder.file_list('linked')) == 100
+        assert len({_.get('id') for _ in al_folder._cache}) == 50
+
+    def test_AudiolinkFolder_create_links_shared_id(self, media_file_empty, tmp_path:Path, tmp_path_factory):
+        link_path = tmp_path_factory.mktemp('links')
+
+        for i in range(20):
+            media_file_empty('.flac').rename(tmp_path.joinpath(f'{i:02}.flac'))
+
+        al_folder = al.AudiolinkFolder(tmp_path, link_path)
+        al_folder.scan_folder()
+        al_folder.set_ids()
+        # a distinct copy of the first file, same id but another inode
+        first = tmp_path.joinpath('00.flac')
+        shutil.copyfile(first, tmp_path.joinpath('00b.flac'))
+        al_folder.scan_folder()
+
+        with pytest.raises(FileExistsError):
+            al_folder.update_links()
+
+        # the copy scanned first gets the link name, the other raises
+        copies = [_.get('path') for _ in al_folder._cache if _.get('id') == al.AudiolinkFile(first).id]
+        link_fp = link_path.joinpath(f'{al.AudiolinkFile(first).id}.flac')
+        assert os.stat(link_fp).st_ino == os.stat(copies[0]).st_ino
+        assert len(list(link_path.iterdir())) == 20
+        # every link made before the error is recorded
+        active = {_.get('path') for _ in al_folder._cache if _.get('link_status') == 'active'}
+        assert active == {str(tmp_path.joinpath(f'{i:02}.flac')) for i in range(1, 20)} | {copies[0]}
+        assert len(al_folder.file_list('linked')) == 20
+
+    def test_AudiolinkFolder_create_links_invalid_id(self, audiolink_folder_empty, tmp_path:Path, tmp_path_factory):
+        link_path = tmp_path_factory.mktemp('links')
+        al_folder = al.AudiolinkFolder(tmp_path, link_path)
+        al_folder.scan_folder()
+        al_folder.set_ids()
+        al_folder._cache[0].update(id='invalid', id_valid=False)
+        al_folder.update_links()
+        assert al_folder._cache[0].get('link_status') is None
+        assert len(list(link_path.iterdir())) == len(file_types) - 1
 
 '''
 def test_generate_id():